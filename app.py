@@ -2,7 +2,7 @@
 import streamlit as st
 import pandas as pd
 from utils.io import load_data, load_geojson
-from utils.prep import clean_and_prep_data
+from utils.prep import clean_and_prep_data, selection_kpis, dept_cube, dept_totals, age_cube
 from utils.viz import (
     plot_kpi_metrics,
     plot_choropleth_map,
@@ -20,81 +20,27 @@ st.set_page_config(
 
 # --- 2. Load and Prepare Data ---
 # Load data using cached functions 
-raw_df = load_data()
+# data_version changes on every reload, it keys the cached aggregations below
+try:
+    raw_df, data_version = load_data()
+except Exception as e:
+    # Reported here rather than in load_data so a failed load is never cached
+    st.error(f"Error loading data: {e}")
+    raw_df, data_version = pd.DataFrame(), None
 geojson = load_geojson()
-df_main, f_cols, h_cols = clean_and_prep_data(raw_df)
-
-st.session_state['f_cols'] = f_cols
-st.session_state['h_cols'] = h_cols
+df_main, f_cols, h_cols, f_labels, h_labels = clean_and_prep_data(raw_df)
 
 if df_main.empty or geojson is None:
     st.error("Failed to load critical data. The app cannot continue.")
     st.stop()
 
-# --- 3. Sidebar Filters ---
-# Place all controls in the sidebar
+# --- 3. Sidebar ---
 with st.sidebar:
     st.image("assets/efrei_logo.png", width=200)
-    st.header("Filters")
-    
-    # Get unique sorted lists for filters
-    all_feds = sorted(df_main['Fédération'].unique())
-    all_regions = sorted(df_main['Région'].unique())
-    
-    # Create filters
-    # The user's request: filter by sports. Default is empty (all sports).
-    selected_feds = st.multiselect(
-        "Select Federation(s)",
-        all_feds,
-        default=[]
-    )
-    
-    selected_regions = st.multiselect(
-        "Select Region(s)",
-        all_regions,
-        default=[]
-    )
-
-    selected_gender = st.radio(
-        "Select Gender",
-        ["All", "Male", "Female"],
-        horizontal=True # C'est plus joli
-    )
-
     st.markdown("---")
     st.markdown("Project by **Enzo Houssiere**")
 
-# --- 4. Filtering Logic ---
-# Create the filtered DataFrame based on selections
-df_filtered = df_main.copy()
-
-if selected_feds:
-    df_filtered = df_filtered[df_filtered['Fédération'].isin(selected_feds)]
-if selected_regions:
-    df_filtered = df_filtered[df_filtered['Région'].isin(selected_regions)]
-
-f_cols = st.session_state.get('f_cols', [])
-h_cols = st.session_state.get('h_cols', [])
-
-if selected_gender == "Male":
-    # Remplacer 'Total_Licences' pour ne compter que les hommes
-    df_filtered['Total_Licences'] = df_filtered['Male_Licences']
-    # Mettre à zéro les femmes pour les KPIs et la pyramide
-    df_filtered['Female_Licences'] = 0
-    for col in f_cols:
-        if col in df_filtered.columns:
-            df_filtered[col] = 0
-
-elif selected_gender == "Female":
-    # Remplacer 'Total_Licences' pour ne compter que les femmes
-    df_filtered['Total_Licences'] = df_filtered['Female_Licences']
-    # Mettre à zéro les hommes pour les KPIs et la pyramide
-    df_filtered['Male_Licences'] = 0
-    for col in h_cols:
-         if col in df_filtered.columns:
-            df_filtered[col] = 0
-
-# --- 5. Main Page Layout ---
+# --- 4. Main Page Layout ---
 st.title("🏅 French Sports Licenses Data Story")
 st.caption("Source: data.gouv.fr - Recensement des licences et clubs 2022")
 
@@ -105,52 +51,113 @@ st.markdown(
     - **Where** are they played?
     - **Who** plays them (age and gender)?
     
-    Use the filters on the left to explore the data.
+    Use the filters below to explore the data.
     """
 )
 
-# Check if filters resulted in empty data
-if df_filtered.empty:
-    st.warning("No data matches your selection. Please adjust the filters.")
-    st.stop()
+# --- 5. Filters and Visuals ---
+# A fragment only reruns this function when one of its widgets changes,
+# not the whole script (data loading, static text...).
+# Streamlit does not allow fragments to write to the sidebar, so the
+# filters are shown at the top of the fragment instead.
+@st.fragment
+def dashboard():
+    st.header("Filters")
 
-# --- Section 1: KPIs ---
-# Display KPIs based on filtered data
-st.subheader("Dashboard Overview for Selection")
-plot_kpi_metrics(df_filtered)
+    # Get unique sorted lists for filters (categories are already sorted)
+    all_feds = df_main['Fédération'].cat.categories.tolist()
+    all_regions = df_main['Région'].cat.categories.tolist()
 
-st.markdown("---")
+    # Create filters
+    # The user's request: filter by sports. Default is empty (all sports).
+    col_fed, col_reg, col_gender = st.columns([2, 2, 1])
+
+    with col_fed:
+        selected_feds = st.multiselect(
+            "Select Federation(s)",
+            all_feds,
+            default=[]
+        )
+
+    with col_reg:
+        selected_regions = st.multiselect(
+            "Select Region(s)",
+            all_regions,
+            default=[]
+        )
+
+    with col_gender:
+        selected_gender = st.radio(
+            "Select Gender",
+            ["All", "Male", "Female"],
+            horizontal=True # C'est plus joli
+        )
+
+    # Filtering Logic
+    # Everything below is cached on the filter selection (lists are passed
+    # as hashable tuples). The gender filter is handled by the plot
+    # functions, so no column is mutated here.
+    feds_key = tuple(selected_feds)
+    regions_key = tuple(selected_regions)
+    total_licences, total_associations = selection_kpis(
+        df_main, data_version, feds_key, regions_key, selected_gender
+    )
 
-# --- Section 2: Map and Age Pyramid ---
-st.subheader("The 'Where' and 'Who' of French Sports")
-col1, col2 = st.columns([2, 1]) # Give more space to the map
+    # Check if filters resulted in empty data
+    if total_associations == 0:
+        st.warning("No data matches your selection. Please adjust the filters.")
+        return
 
-with col1:
-    # Map is mandatory
-    fig_map = plot_choropleth_map(df_filtered, geojson)
-    st.plotly_chart(fig_map, use_container_width=True)
+    # --- Section 1: KPIs ---
+    # Display KPIs based on filtered data
+    st.subheader("Dashboard Overview for Selection")
+    plot_kpi_metrics(total_licences, total_associations)
 
-with col2:
-    # Age pyramid (one of 3+ interactive visuals)
-    fig_pyramid = plot_age_pyramid(df_filtered)
-    st.plotly_chart(fig_pyramid, use_container_width=True)
+    st.markdown("---")
 
-st.markdown("---")
+    # --- Section 2: Map and Age Pyramid ---
+    st.subheader("The 'Where' and 'Who' of French Sports")
+    col1, col2 = st.columns([2, 1]) # Give more space to the map
+
+    with col1:
+        # Map is mandatory (department totals from the cached department cube)
+        df_dept = dept_totals(
+            dept_cube(df_main, data_version), data_version, feds_key, regions_key, selected_gender
+        )
+        fig_map = plot_choropleth_map(df_dept, geojson)
+        st.plotly_chart(fig_map, use_container_width=True)
+
+    with col2:
+        # Age pyramid (one of 3+ interactive visuals), from the cached age cube
+        fig_pyramid = plot_age_pyramid(
+            age_cube(df_main, data_version, f_cols + h_cols), data_version,
+            f_cols, h_cols, f_labels, h_labels,
+            feds_key, regions_key, selected_gender
+        )
+        st.plotly_chart(fig_pyramid, use_container_width=True)
+
+    st.markdown("---")
+
+    # --- Section 3: Federation Rankings ---
+    st.subheader("What are the most popular sports?")
 
-# --- Section 3: Federation Rankings ---
-st.subheader("What are the most popular sports?")
+    col_bar1, col_bar2 = st.columns(2)
 
-col_bar1, col_bar2 = st.columns(2)
+    with col_bar1:
+        # Second interactive visual
+        fig_bar_lic = plot_top_federations(
+            df_main, data_version, feds_key, regions_key, by='licences', gender=selected_gender
+        )
+        st.plotly_chart(fig_bar_lic, use_container_width=True)
 
-with col_bar1:
-    # Second interactive visual
-    fig_bar_lic = plot_top_federations(df_filtered, by='licences')
-    st.plotly_chart(fig_bar_lic, use_container_width=True)
+    with col_bar2:
+        # Third interactive visual
+        fig_bar_imp = plot_top_federations(
+            df_main, data_version, feds_key, regions_key, by='implantation', gender=selected_gender
+        )
+        st.plotly_chart(fig_bar_imp, use_container_width=True)
 
-with col_bar2:
-    # Third interactive visual
-    fig_bar_imp = plot_top_federations(df_filtered, by='implantation')
-    st.plotly_chart(fig_bar_imp, use_container_width=True)
+dashboard()
 
 st.markdown("---")
 
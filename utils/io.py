@@ -1,7 +1,16 @@
 # utils/io.py
+import csv
+import os
+import tempfile
+import time
+import urllib.request
+import orjson
 import streamlit as st
 import pandas as pd
-import requests
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
+from utils.prep import used_columns
 
 # This is the dataset URL from your prompt
 DATA_URL = "https://www.data.gouv.fr/api/1/datasets/r/ce39c9d6-2e7f-4a05-9f95-9e6c06b38219"
@@ -9,34 +18,105 @@ DATA_URL = "https://www.data.gouv.fr/api/1/datasets/r/ce39c9d6-2e7f-4a05-9f95-9e
 # This is a reliable GeoJSON for French departments
 GEOJSON_URL = "https://raw.githubusercontent.com/gregoiredavid/france-geojson/master/departements.geojson"
 
-@st.cache_data(show_spinner="Loading license data...")
-def load_data():
+# Local Parquet copy of the parsed dataset, shared by all sessions and restarts.
+# Named after the data.gouv.fr resource id so other apps' files never collide
+PARQUET_PATH = os.path.join(tempfile.gettempdir(), f"licenses_{os.path.basename(DATA_URL)}.parquet")
+
+# Re-download the dataset once the local copy is older than this (seconds)
+PARQUET_MAX_AGE = 7 * 24 * 3600
+
+def _download_csv_table():
     """
-    Loads the main sports license dataset from data.gouv.fr.
-    Specifies dtypes for geographic codes to preserve leading zeros.
+    Downloads the CSV from data.gouv.fr and parses it with pyarrow
+    (multi-threaded C parser) into an Arrow table.
+    Specifies types for geographic codes to preserve leading zeros.
     """
-    # Specify dtypes to keep codes like '01' or '2A' as strings
-    dtypes_spec = {
-        "Code Commune": str,
-        "Code QPV": str,
-        "Département": str,
-        "Code": str, # Federation Code
+    with urllib.request.urlopen(DATA_URL, timeout=60) as response:
+        raw = response.read()
+
+    # Specify types to keep codes like '01' or '2A' as strings
+    column_types = {
+        "Code Commune": pa.string(),
+        "Code QPV": pa.string(),
+        "Département": pa.string(),
+        "Code": pa.string(), # Federation Code
     }
-    
+
+    # pyarrow infers column types from the first block and fails on a later
+    # non-numeric cell: read the licence counts as strings, clean_and_prep_data
+    # coerces them to numbers
+    header = next(csv.reader([raw.split(b'\n', 1)[0].decode('utf-8-sig').rstrip('\r')], delimiter=';'))
+    for col in header:
+        if col == 'Total' or ' - ' in col:
+            column_types[col] = pa.string()
+
+    return pacsv.read_csv(
+        pa.BufferReader(raw),
+        parse_options=pacsv.ParseOptions(delimiter=';'),
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types,
+            strings_can_be_null=True # Empty cells become NaN, as with pd.read_csv
+        )
+    )
+
+def _parquet_is_fresh():
+    """
+    True if the local Parquet copy exists and is younger than PARQUET_MAX_AGE.
+    """
     try:
-        df = pd.read_csv(DATA_URL, sep=';', dtype=dtypes_spec)
-        return df
-    except Exception as e:
-        st.error(f"Error loading data: {e}")
-        return pd.DataFrame()
+        return time.time() - os.path.getmtime(PARQUET_PATH) < PARQUET_MAX_AGE
+    except OSError:
+        return False
+
+@st.cache_data(ttl=PARQUET_MAX_AGE, show_spinner="Loading license data...")
+def load_data():
+    """
+    Loads the main sports license dataset.
+    Reads the local Parquet copy when it is fresh, otherwise downloads and
+    parses the CSV from data.gouv.fr and saves it as Parquet for next time.
+    Only the columns used by clean_and_prep_data are loaded, and string
+    columns are kept Arrow-backed instead of one Python object per cell.
+    Errors are raised, not cached: the caller reports them.
+    Returns (df, data_version): data_version is the load timestamp, passed
+    to the cached helpers so their entries never outlive this dataset.
+    """
+    table = None
+    if _parquet_is_fresh():
+        try:
+            columns = used_columns(pq.read_schema(PARQUET_PATH).names)
+            table = pq.read_table(PARQUET_PATH, columns=columns)
+        except (OSError, pa.ArrowException):
+            table = None # Unreadable copy: download the dataset again below
+
+    if table is None:
+        table = _download_csv_table()
+        tmp_path = None
+        try:
+            # Write to a file unique to this writer, then rename, so neither a
+            # crash nor another process loading at the same time can leave a
+            # truncated or interleaved file behind
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(PARQUET_PATH), suffix=".tmp", delete=False) as tmp:
+                tmp_path = tmp.name
+                pq.write_table(table, tmp, compression="snappy")
+            os.replace(tmp_path, PARQUET_PATH)
+        except OSError:
+            # Read-only filesystem: the in-memory cache still applies
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        table = table.select(used_columns(table.column_names))
+
+    df = table.to_pandas(types_mapper={pa.string(): pd.ArrowDtype(pa.string())}.get)
+    return df, time.time()
 
-@st.cache_data(show_spinner="Loading map data...")
+# Shared (not copied) across reruns and sessions: read-only, never mutate
+@st.cache_resource(show_spinner="Loading map data...")
 def load_geojson():
     """
     Loads the GeoJSON file for department boundaries.
     """
     try:
-        geojson = requests.get(GEOJSON_URL).json()
+        with urllib.request.urlopen(GEOJSON_URL, timeout=30) as response:
+            geojson = orjson.loads(response.read())
         return geojson
     except Exception as e:
         st.error(f"Error loading GeoJSON map: {e}")
@@ -1,37 +1,196 @@
 # utils/prep.py
 import streamlit as st
+import numpy as np
 import pandas as pd
 
+# Licence column to aggregate for each option of the gender filter
+GENDER_LICENCE_COLS = {
+    "All": "Total_Licences",
+    "Male": "Male_Licences",
+    "Female": "Female_Licences",
+}
+
+# Raw label and total columns kept by clean_and_prep_data, before the age groups
+LABEL_COLS = ['Fédération', 'Région', 'Département', 'Code Commune', 'Total']
+
+def used_columns(columns):
+    """
+    Returns the raw columns kept by clean_and_prep_data: the labels, the
+    'Total' count and every age-group column ('F - ...' / 'H - ...').
+    """
+    return LABEL_COLS + [col for col in columns if ' - ' in col]
+
 @st.cache_data
 def clean_and_prep_data(df_raw):
     """
     Cleans the raw DataFrame:
-    1. Renames columns for clarity.
-    2. Converts all age-group columns to numeric, filling NaNs with 0.
-    3. Creates new columns for total Female and Male licenses.
+    1. Keeps only the columns used by the app and renames them for clarity.
+    2. Converts the geographic/federation labels to 'category' dtype.
+    3. Converts all age-group columns to numeric, filling NaNs with 0.
+    4. Creates new columns for total Female and Male licenses.
+    Also returns the age-group labels (without the 'F - '/'H - ' prefix)
+    so the age pyramid does no string work on each rerun.
     """
 
     if df_raw.empty:
-        return pd.DataFrame(), [], []
+        return pd.DataFrame(), [], [], [], []
 
-    df = df_raw.copy()
-    
-    # 1. Rename 'Total' column
-    df = df.rename(columns={"Total": "Total_Licences"})
+    # 1. Keep only the columns used downstream (copies nothing else), rename 'Total'
+    keep = used_columns(df_raw.columns)
+    age_cols = keep[len(LABEL_COLS):]
+    df = df_raw[keep].rename(columns={"Total": "Total_Licences"})
 
-    # 2. Find all age columns and convert to numeric
-    age_cols = [col for col in df.columns if ' - ' in col]
-    for col in age_cols + ['Total_Licences']:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # 2. Store labels as integer codes (fast isin/groupby, lower memory)
+    for col in ('Fédération', 'Région', 'Département'):
+        df[col] = df[col].astype('category')
 
-    df[age_cols + ['Total_Licences']] = df[age_cols + ['Total_Licences']].fillna(0).astype(int)
+    # 3. Convert all age columns to numeric, non-numeric or missing cells become 0
+    # (to_numeric on Arrow-backed strings yields NaN values, not nulls, so
+    # they are replaced on the NumPy array rather than with fillna).
+    # Licence counts fit in int32: half the bytes of int64 for every sum/groupby
+    for col in age_cols + ['Total_Licences']:
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        df[col] = np.nan_to_num(values, nan=0).astype(np.int32)
 
-    # 3. Create total columns for Gender
+    # 4. Create total columns for Gender
     f_cols = [col for col in age_cols if col.startswith('F - ')]
     h_cols = [col for col in age_cols if col.startswith('H - ')]
+    f_labels = np.array([col.removeprefix('F - ') for col in f_cols])
+    h_labels = np.array([col.removeprefix('H - ') for col in h_cols])
+
+    # Sum each gender block in one vectorized pass over a contiguous int32 matrix
+    age_mat = df[age_cols].to_numpy(dtype=np.int32, copy=False)
+    f_idx = [age_cols.index(col) for col in f_cols]
+    h_idx = [age_cols.index(col) for col in h_cols]
+
+    df['Female_Licences'] = age_mat[:, f_idx].sum(axis=1, dtype=np.int32)
+    df['Male_Licences'] = age_mat[:, h_idx].sum(axis=1, dtype=np.int32)
+
+
+    return df, f_cols, h_cols, f_labels, h_labels
+
+def _category_mask(values, selected):
+    """
+    Boolean mask of the entries of a categorical Series/Index whose value
+    is in 'selected', computed with np.isin on the integer codes instead
+    of hashing every string.
+    """
+    cat = values.array
+    if not isinstance(cat, pd.Categorical):
+        return np.asarray(values.isin(selected))
+
+    # Map the selected labels to their codes (-1 = unknown label, dropped)
+    selected_codes = cat.categories.get_indexer(list(selected))
+    return np.isin(cat.codes, selected_codes[selected_codes >= 0])
+
+def _selection_mask(fed_values, region_values, feds, regions):
+    """
+    Boolean mask of the entries matching the selected federations and
+    regions (an empty selection means "all").
+    """
+    mask = np.ones(len(fed_values), dtype=bool)
+
+    if feds:
+        mask &= _category_mask(fed_values, feds)
+    if regions:
+        mask &= _category_mask(region_values, regions)
+
+    return mask
+
+@st.cache_data(max_entries=32, ttl="10m")
+def filter_mask(_df_main, data_version, feds, regions):
+    """
+    Boolean mask of the rows of the main DataFrame matching the selected
+    federations and regions (an empty selection means "all").
+    _df_main is the output of clean_and_prep_data and is not hashed: the
+    cache is keyed on data_version (returned by load_data) and the
+    (feds, regions) tuples. Only the mask (one byte per row) is stored,
+    never a copy of the rows.
+    """
+    return _selection_mask(_df_main['Fédération'], _df_main['Région'], feds, regions)
 
-    df['Female_Licences'] = df[f_cols].sum(axis=1)
-    df['Male_Licences'] = df[h_cols].sum(axis=1)
-    
+@st.cache_data(max_entries=32, ttl="10m")
+def selection_kpis(_df_main, data_version, feds, regions, gender='All'):
+    """
+    Total licences (of the selected gender) and number of associations
+    for the selected federations and regions.
+    Returns a (total_licences, total_associations) tuple of ints.
+    """
+    mask = filter_mask(_df_main, data_version, feds, regions)
+    total_licences = _df_main[GENDER_LICENCE_COLS[gender]].to_numpy()[mask].sum()
+    return int(total_licences), int(mask.sum())
 
-    return df, f_cols, h_cols
+@st.cache_data(max_entries=32, ttl="10m")
+def top_feds_for_filters(_df_main, data_version, feds, regions, gender='All'):
+    """
+    Top 15 federations for the selected federations and regions, both by
+    number of licences (of the selected gender) and by number of
+    associations (rows). Both rankings come from a single groupby.
+    Returns a (top_by_licences, top_by_count) tuple of DataFrames.
+    """
+    licence_col = GENDER_LICENCE_COLS[gender]
+    # Only the two columns needed are taken from the selected rows
+    df_filtered = _df_main.loc[filter_mask(_df_main, data_version, feds, regions), ['Fédération', licence_col]]
+
+    # groupby(observed=True) skips the categories emptied by the filter
+    agg = df_filtered.groupby('Fédération', observed=True).agg(
+        Total_Licences=(licence_col, 'sum'),
+        Count=(licence_col, 'size')
+    )
+    return agg.nlargest(15, 'Total_Licences').reset_index(), agg.nlargest(15, 'Count').reset_index()
+
+@st.cache_data
+def dept_cube(_df_main, data_version):
+    """
+    Pre-aggregates licences and associations per
+    (Département, Fédération, Région), computed once per dataset
+    (keyed on data_version, returned by load_data).
+    The result has a few thousand rows, so department totals for any
+    selection can be derived from it instead of the raw rows.
+    """
+    return _df_main.groupby(['Département', 'Fédération', 'Région'], observed=True, dropna=False).agg(
+        Total_Licences=('Total_Licences', 'sum'),
+        Female_Licences=('Female_Licences', 'sum'),
+        Male_Licences=('Male_Licences', 'sum'),
+        Nb_Associations=('Code Commune', 'count')
+    )
+
+@st.cache_data
+def age_cube(_df_main, data_version, age_cols):
+    """
+    Pre-aggregates the age-group columns per (Fédération, Région),
+    computed once per dataset (keyed on data_version, returned by
+    load_data). Age totals for any selection are then a
+    sum over a few hundred rows instead of the whole filtered frame.
+    """
+    return _df_main.groupby(['Fédération', 'Région'], observed=True, dropna=False)[age_cols].sum()
+
+def select_cube(cube, feds, regions):
+    """
+    Returns the rows of a pre-aggregated cube (indexed by at least
+    'Fédération' and 'Région') matching the selected federations and regions.
+    """
+    mask = _selection_mask(
+        cube.index.get_level_values('Fédération'),
+        cube.index.get_level_values('Région'),
+        feds,
+        regions
+    )
+    return cube[mask]
+
+@st.cache_data(max_entries=16)
+def dept_totals(_cube, data_version, feds, regions, gender='All'):
+    """
+    Licences (of the selected gender) and associations per department for
+    the selected federations and regions, summed from the cube built by
+    dept_cube. Returns a ~100-row DataFrame with 'Département',
+    'Total_Licences' and 'Nb_Associations' columns.
+    """
+    licence_col = GENDER_LICENCE_COLS[gender]
+    return (
+        select_cube(_cube, feds, regions)
+        .groupby(level='Département', observed=True)[[licence_col, 'Nb_Associations']]
+        .sum()
+        .reset_index()
+        .rename(columns={licence_col: 'Total_Licences'})
+    )
\ No newline at end of file
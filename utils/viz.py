@@ -1,9 +1,9 @@
 # utils/viz.py
 import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import streamlit as st
+from utils.prep import select_cube, top_feds_for_filters
 
 def simple_si_format(val):
     """Formate un nombre en 'k' (milliers) ou 'M' (millions)"""
@@ -14,14 +14,11 @@ def simple_si_format(val):
         return f'{val/1_000:.0f}k' # ex: 500k
     return f'{val:.0f}' # ex: 0
 
-def plot_kpi_metrics(df_filtered):
+def plot_kpi_metrics(total_licences, total_associations):
     """
     Displays the 4 main KPIs in st.metric columns.
-    Calculates KPIs based *only* on the filtered data.
+    The totals are computed on the filtered data by selection_kpis.
     """
-    # Calculate KPIs from the filtered dataframe
-    total_licences = df_filtered['Total_Licences'].sum()
-    total_associations = len(df_filtered)
 
     if total_associations > 0:
         avg_lic_per_club = total_licences / total_associations
@@ -43,16 +40,13 @@ def plot_kpi_metrics(df_filtered):
         value=f"{avg_lic_per_club:,.1f}" # On affiche avec une décimale
     )
 
-def plot_choropleth_map(df_filtered, geojson):
+def plot_choropleth_map(df_dept, geojson):
     """
-    Creates the choropleth mapbox figure based on filtered data.
+    Creates the choropleth mapbox figure from the department totals
+    returned by dept_totals.
+    Not cached: a cached figure would hold its own copy of the GeoJSON,
+    so only the small df_dept aggregate is cached.
     """
-    # Aggregate filtered data by department
-    df_dept = df_filtered.groupby('Département').agg(
-        Total_Licences=('Total_Licences', 'sum'),
-        Nb_Associations=('Code Commune', 'count')
-    ).reset_index()
-
     fig = px.choropleth_mapbox(
         df_dept, 
         geojson=geojson, 
@@ -80,46 +74,36 @@ def plot_choropleth_map(df_filtered, geojson):
     )
     return fig
 
-def plot_age_pyramid(df_filtered):
+@st.cache_data(max_entries=16)
+def plot_age_pyramid(_cube, data_version, f_cols, h_cols, f_labels, h_labels, feds=(), regions=(), gender='All'):
     """
-    Creates the age pyramid for the selected federations.
-    CORRECTED:
-    - Fixed order of operations for data_h['Abs_Licences']
-    - Moved 'data_pyramide.empty' check to *after* concatenation
+    Creates the age pyramid for the selected federations and regions,
+    from the age cube built by age_cube.
+    f_cols/h_cols and f_labels/h_labels are the age columns and labels
+    returned by clean_and_prep_data.
+    Cached on data_version and the filter arguments; returns the figure as a dict.
     """
-    # Retrieve column lists from session_state
-    f_cols = st.session_state.get('f_cols', [])
-    h_cols = st.session_state.get('h_cols', [])
-
     if not f_cols or not h_cols:
-        return go.Figure().update_layout(title="Age pyramid data not available.")
+        return go.Figure().update_layout(title="Age pyramid data not available.").to_dict()
 
-    if df_filtered.empty:
-        return go.Figure().update_layout(title="No data for this selection.")
-    
-    # Aggregate all data in the filtered selection
-    data_agg = df_filtered[f_cols + h_cols].sum()
-    
-    data_f = data_agg[f_cols].reset_index()
-    data_f.columns = ['Tranche', 'Licences']
-    data_f['Tranche'] = data_f['Tranche'].str.replace('F - ', '')
-    data_f['Sexe'] = 'Female'
-    data_f['Abs_Licences'] = data_f['Licences']
-    
-    data_h = data_agg[h_cols].reset_index()
-    data_h.columns = ['Tranche', 'Licences']
-    data_h['Tranche'] = data_h['Tranche'].str.replace('H - ', '')
-    data_h['Sexe'] = 'Male'
-    data_h['Abs_Licences'] = data_h['Licences']
-    data_h['Licences'] = -data_h['Licences']
+    df_selected = select_cube(_cube, feds, regions)
+
+    if df_selected.empty:
+        return go.Figure().update_layout(title="No data for this selection.").to_dict()
     
-    # 3. Create the dataframe FIRST
-    data_pyramide = pd.concat([data_f, data_h])
+    # Only sum the age columns of the selected gender, the other side is 0
+    if gender == 'Male':
+        gender_cols = h_cols
+    elif gender == 'Female':
+        gender_cols = f_cols
+    else:
+        gender_cols = f_cols + h_cols
 
-    # 4. Check if it's empty AFTER creation
-    if data_pyramide.empty:
-       return go.Figure().update_layout(title="No age data to display.")
+    data_agg = df_selected[gender_cols].sum().reindex(f_cols + h_cols, fill_value=0)
     
+    vals_f = data_agg[f_cols].to_numpy()
+    vals_h = data_agg[h_cols].to_numpy()
+
     # Define the correct order
     age_order = [
         '1 à 4 ans', '5 à 9 ans', '10 à 14 ans', '15 à 19 ans', 
@@ -128,33 +112,29 @@ def plot_age_pyramid(df_filtered):
         '60 à 64 ans', '65 à 69 ans', '70 à 74 ans', '75 à 79 ans', '80 à 99 ans', 'NR'
     ]
 
-    fig = px.bar(
-        data_pyramide,
-        y='Tranche',
-        x='Licences',
-        color='Sexe',
-        orientation='h',
-        title='Who are the athletes? (Age & Gender Pyramid)',
-        category_orders={'Tranche': age_order},
-        labels={'Licences': 'Number of Licences'},
-        barmode='relative',
-        template='plotly_white',
-        color_discrete_map={'Female': 'purple', 'Male': 'orange'},
-        custom_data=['Sexe', 'Abs_Licences']
-    )
-    
-    # Clean up tooltips and axes
-    fig.update_traces(
-        hovertemplate='Sexe: %{customdata[0]}<br>Age: %{y}<br>Licences: %{customdata[1]:,.0f}<extra></extra>'
-    )
-
-    # This check is now redundant, but safe
-    if 'Abs_Licences' not in data_pyramide.columns:
-            st.error("Data error: 'Abs_Licences' column is missing.")
-            return fig
+    # One bar trace per gender, males on the negative side of the axis
+    fig = go.Figure(data=[
+        go.Bar(
+            y=f_labels,
+            x=vals_f,
+            orientation='h',
+            name='Female',
+            marker_color='purple',
+            customdata=vals_f,
+            hovertemplate='Sexe: Female<br>Age: %{y}<br>Licences: %{customdata:,.0f}<extra></extra>'
+        ),
+        go.Bar(
+            y=h_labels,
+            x=-vals_h,
+            orientation='h',
+            name='Male',
+            marker_color='orange',
+            customdata=vals_h,
+            hovertemplate='Sexe: Male<br>Age: %{y}<br>Licences: %{customdata:,.0f}<extra></extra>'
+        )
+    ])
 
-    # This line (131 in your old file) should now work
-    max_val = data_pyramide['Abs_Licences'].max() 
+    max_val = max(vals_f.max(initial=0), vals_h.max(initial=0))
     max_val = max_val * 1.1
 
     # Handle case where max_val is 0
@@ -165,43 +145,60 @@ def plot_age_pyramid(df_filtered):
     tick_text = [simple_si_format(val) for val in tick_vals]
 
     fig.update_layout(
+        title='Who are the athletes? (Age & Gender Pyramid)',
+        barmode='relative',
+        template='plotly_white',
+        legend_title_text='Sexe',
         xaxis_title='Number of Licences', 
         yaxis_title='Age Group',
         xaxis=dict(
             tickvals=tick_vals,
             ticktext=tick_text,
             range=[-max_val, max_val]
+        ),
+        yaxis=dict(
+            categoryorder='array',
+            categoryarray=age_order[::-1] # Youngest at the top, as px.bar drew it
         )
     )
-    return fig
+    return fig.to_dict()
 
-def plot_top_federations(df_filtered, by='licences'):
+@st.cache_data(max_entries=16)
+def plot_top_federations(_df_main, data_version, feds=(), regions=(), by='licences', gender='All'):
     """
     Creates horizontal bar charts for top 15 federations.
     Can plot by 'licences' or 'implantation'.
+    Cached on data_version and the filter arguments; returns the figure as a dict.
     """
+    # Both charts share the same cached aggregation
+    top_licences, top_count = top_feds_for_filters(_df_main, data_version, feds, regions, gender)
+
     if by == 'licences':
-        df_agg = df_filtered.groupby('Fédération')['Total_Licences'].sum().nlargest(15).reset_index().sort_values(by='Total_Licences', ascending=True)
+        df_agg = top_licences.sort_values(by='Total_Licences', ascending=True)
         x_col = 'Total_Licences'
         title = 'Top 15 Federations by Licences'
         x_label = 'Total Licences'
     else:
         # Count number of rows (associations)
-        df_agg = df_filtered['Fédération'].value_counts().nlargest(15).reset_index().sort_values(by='count', ascending=True)
-        df_agg.columns = ['Fédération', 'Count']
+        df_agg = top_count.sort_values(by='Count', ascending=True)
         x_col = 'Count'
         title = 'Top 15 Federations by Implantation'
         x_label = 'Number of Associations'
 
-    fig = px.bar(
-        df_agg,
-        x=x_col,
-        y='Fédération',
-        orientation='h',
+    fig = go.Figure(data=[
+        go.Bar(
+            x=df_agg[x_col].to_numpy(),
+            y=df_agg['Fédération'].to_numpy(),
+            orientation='h',
+            text=df_agg[x_col].to_numpy(),
+            texttemplate='%{text:,.0s}',
+            textposition='outside',
+            hovertemplate=f'%{{y}}<br>{x_label}: %{{x:,.0f}}<extra></extra>'
+        )
+    ])
+    fig.update_layout(
         title=title,
-        labels={x_col: x_label, 'Fédération': ''},
-        text=x_col
+        xaxis_title=x_label,
+        yaxis=dict(tickfont=dict(size=10))
     )
-    fig.update_traces(texttemplate='%{text:,.0s}', textposition='outside')
-    fig.update_layout(yaxis=dict(tickfont=dict(size=10)))
-    return fig
\ No newline at end of file
+    return fig.to_dict()
\ No newline at end of file